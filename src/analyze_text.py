@@ -1,36 +1,85 @@
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import re
 import os
+import csv
 import glob
 import json
 from collections import defaultdict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 dict_file = "src/data/cata-dict.xlsx"
 json_file_path = "src/data/task_cutoffs.json"
 
-def analyze_text(transcript_path, output_speaker_dir, result_path, task_cutoff):
-    # Load transcription data and CATA dictionary
-    transcript_df = pd.read_csv(transcript_path)
-    dictionary_df = pd.read_excel(dict_file, sheet_name='Marks_v2')
-    
-    # only save the words and diction_code columns
-    dictionary_df = dictionary_df[['words', 'diction_code']]
-    
-    # Convert 'start' and 'end' columns to numeric, forcing non-numeric values to NaN
-    transcript_df['start'] = pd.to_numeric(transcript_df['start'], errors='coerce')
-    transcript_df['end'] = pd.to_numeric(transcript_df['end'], errors='coerce')
+# Define window params
+window_size = 30    # 30-second window
+step_size   = 15    # 15-second overlap step
 
-    # Drop rows where conversion failed (if any)
-    transcript_df.dropna(subset=['start', 'end'], inplace=True)
-    
-    # Only keep rows between start and end cutoff times
-    transcript_df = transcript_df[
-        (transcript_df['start'] >= task_cutoff['start']) & (transcript_df['end'] <= task_cutoff['end'])]
-    
-    # Extract category-wise words, handling wildcards and context-based words
-    category_words = defaultdict(set)  # Stores direct words (key: category, value: set of words)
-    category_patterns = defaultdict(list)  # Stores regex patterns and context-based words
+# Offsets from an utterance's last window to every window that can contain it,
+# padded by one on each side to absorb floating-point rounding. They depend only
+# on the window params, so they are computed once at import.
+window_offsets = np.arange(-1, int(np.ceil(window_size / step_size)) + 1)
+
+# Concatenate the index ranges [start, start + length) for each (start, length) pair
+def expand_ranges(starts, lengths):
+    ends = np.cumsum(lengths)
+    return np.repeat(starts + lengths - ends, lengths) + np.arange(lengths.sum())
+
+# Write a DataFrame as CSV through one large buffered file handle, leaving
+# flushing to the OS instead of formatting and writing row by row in pandas
+def write_csv(df, path):
+    with open(path, 'w', newline='', buffering=1 << 20) as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(df.columns)
+        writer.writerows(df.fillna('').itertuples(index=False, name=None))
+
+# Pair every utterance with the windows it falls in, in one vectorized pass.
+# Condition: utterance belongs to a window if window_start <= end < window_end,
+# so its last window is floor((end - first window start) / step_size); the
+# candidates around it are checked against the exact condition.
+# Returns (row_ids, window_ids), sorted by utterance.
+def assign_windows(ends, time_points, first_start):
+    last_window = np.floor((ends - first_start) / step_size).astype(int)
+    row_ids = np.repeat(np.arange(len(ends)), len(window_offsets))
+    window_ids = (last_window[:, None] - window_offsets).ravel()
+
+    in_range = (window_ids >= 0) & (window_ids < len(time_points))
+    row_ids, window_ids = row_ids[in_range], window_ids[in_range]
+    window_starts = time_points[window_ids]
+    in_window = (ends[row_ids] >= window_starts) & (ends[row_ids] < window_starts + window_size)
+    return row_ids[in_window], window_ids[in_window]
+
+# Load the CATA dictionary, re-parsing it only when the file has changed
+def load_dictionary(dict_file):
+    return parse_dictionary(dict_file, os.path.getmtime(dict_file))
+
+# Parse the CATA dictionary into lookup tables shared by every transcript.
+# Cached per (file, modification time), so reruns in a notebook skip the Excel parse.
+@lru_cache(maxsize=None)
+def parse_dictionary(dict_file, mtime):
+    # Read the dictionary from a parquet copy of the Excel sheet, which loads far
+    # faster than openpyxl; the copy is regenerated whenever the Excel file is newer
+    parquet_file = os.path.splitext(dict_file)[0] + '.parquet'
+    if os.path.exists(parquet_file) and os.path.getmtime(parquet_file) >= mtime:
+        dictionary_df = pd.read_parquet(parquet_file)
+    else:
+        dictionary_df = pd.read_excel(dict_file, sheet_name='Marks_v2')
+
+        # only save the words and diction_code columns (words as text, since Excel
+        # parses entries such as "true" as booleans)
+        dictionary_df = dictionary_df[['words', 'diction_code']].astype({'words': str})
+        dictionary_df.to_parquet(parquet_file, index=False)
+
+    # Extract category-wise words, handling wildcards and context-based words.
+    # The dictionary is inverted so that a token is resolved against every
+    # category in a single lookup instead of once per category.
+    word_categories = defaultdict(set)     # Stores direct words (key: word, value: set of categories)
+    prefix_categories = defaultdict(list)  # Stores trailing-wildcard prefixes (key: prefix, value: categories)
+    other_patterns = []                    # Stores any other wildcard as (regex pattern, category)
+    all_categories = set()
 
     for _, row in dictionary_df.iterrows():
         word = str(row['words']).strip().lower()  # Normalize word
@@ -39,115 +88,183 @@ def analyze_text(transcript_path, output_speaker_dir, result_path, task_cutoff):
         # Skip negative diction codes
         if category[0]== 'N':
             continue
+        all_categories.add(category)
 
         # Handle wildcard "*"
-        if '*' in word:
+        if re.fullmatch(r'\w+\*', word):
+            prefix_categories[word[:-1]].append(category)  # "abandon*" matches any token starting with "abandon"
+        elif '*' in word:
             regex_pattern = re.sub(r'\*', r'.*', word)  # Convert * to regex pattern
-            category_patterns[category].append(re.compile(regex_pattern))
+            other_patterns.append((re.compile(regex_pattern), category))
         else:
-            category_words[category].add(word)  # Store as a normal word
+            word_categories[word].add(category)  # Store as a normal word
+
+    all_categories = sorted(all_categories)
+    cat_to_id = {cat: i for i, cat in enumerate(all_categories)}
+
+    # Fuse the remaining wildcards into one alternation, so a token matching none
+    # of them is rejected with a single regex call instead of one per pattern
+    any_other_pattern = re.compile('|'.join(f'(?:{pat.pattern})' for pat, _ in other_patterns)) if other_patterns else None
+
+    return {
+        'categories': all_categories,
+        # Flat (word, cat_id) table of direct words, so every token is resolved with one hash probe
+        'word_to_cat': pd.DataFrame(
+            [(word, cat_to_id[cat]) for word, cats in word_categories.items() for cat in sorted(cats)],
+            columns=['word', 'cat_id']),
+        # Same for trailing-wildcard prefixes, with one row per pattern
+        'prefix_to_cat': pd.DataFrame(
+            [(prefix, cat_to_id[cat]) for prefix, cats in prefix_categories.items() for cat in cats],
+            columns=['prefix', 'cat_id']),
+        'other_patterns': [(pat, cat_to_id[cat]) for pat, cat in other_patterns],
+        'any_other_pattern': any_other_pattern,
+    }
+
+# (code, cat_id) pairs for the keys (indexed by vocabulary code) found in a
+# (key, cat_id) table; isin filters with a hash probe before the join
+def lookup_codes(keys, table, key):
+    hits = keys[keys.isin(table[key])]
+    return pd.DataFrame({'code': hits.index, key: hits.to_numpy()}).merge(table, on=key)[['code', 'cat_id']]
+
+def analyze_text(transcript_path, output_speaker_dir, result_path, task_cutoff, cata_dict):
+    # Load transcription data with the Arrow CSV reader, parsing only the columns
+    # used below; speakers are dictionary-encoded, so they arrive as categorical
+    # codes for cheap grouping and sorting
+    transcript_df = pa_csv.read_csv(
+        transcript_path,
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=['start', 'end', 'text', 'speaker'],
+            column_types={'text': pa.string(), 'speaker': pa.dictionary(pa.int32(), pa.string())},
+            strings_can_be_null=True),
+    ).to_pandas()
+    all_categories = cata_dict['categories']
+    
+    # Convert 'start' and 'end' columns to numeric, forcing non-numeric values to NaN
+    transcript_df['start'] = pd.to_numeric(transcript_df['start'], errors='coerce')
+    transcript_df['end'] = pd.to_numeric(transcript_df['end'], errors='coerce')
+
+    # Drop rows where conversion failed (if any)
+    transcript_df.dropna(subset=['start', 'end'], inplace=True)
+    
+    # Only keep rows between start and end cutoff times
+    transcript_df = transcript_df[
+        (transcript_df['start'] >= task_cutoff['start']) & (transcript_df['end'] <= task_cutoff['end'])]
             
     # Preprocess transcript
     transcript_df = transcript_df[['start', 'end', 'text', 'speaker']].dropna()
-    transcript_df['text'] = transcript_df['text'].str.lower().apply(lambda x: re.findall(r'\b\w+\b', x))
+    transcript_df['text'] = transcript_df['text'].str.lower().str.findall(r'\b\w+\b')  # Tokenize once (lowercase, alphanumeric)
     
-    # Define window params
-    window_size = 30    # 30-second window
-    step_size   = 15    # 15-second overlap step
-
     # Participant devices
     participant_speakers = ["HCILab1", "HCILab2", "CSL_Laptop", "CSL_LabPC"]
     
     # Create time series data structures
     time_points = np.arange(task_cutoff['start'], task_cutoff['end'], step_size)
-    speaker_time_series = []  # Will hold (speaker, window_start, window_end, category_counts...)
-    all_categories = set(category_words.keys()) | set(category_patterns.keys())
-    
-    for t in time_points:
-        window_start = t
-        window_end   = t + window_size
-    
-        # Filter transcript rows overlapping this window
-        # Condition: utterance overlaps if start < window_end and end >= window_start
-        df_window = transcript_df[
-            transcript_df['speaker'].isin(participant_speakers) &
-            (transcript_df['end'] < window_end) &
-            (transcript_df['end'] >= window_start)
-            ]
-        
-        # We'll keep track of counts for each speaker → each category
-        # e.g., speaker_category[speaker][category] = count
-        speaker_category = defaultdict(lambda: defaultdict(int))
-        
-        # For each row, tokenize and match words
-        for _, row in df_window.iterrows():
-            speaker = row['speaker']
-            
-            # Tokenize text (lowercase, alphanumeric)
-            tokens = re.findall(r'\b\w+\b', str(row['text']).lower())
-            
-            # Match direct words
-            for cat, words_set in category_words.items():
-                for token in tokens:
-                    if token in words_set:
-                        speaker_category[speaker][cat] += 1
-            
-            # Match wildcard/regex patterns
-            for cat, pattern_list in category_patterns.items():
-                for pat in pattern_list:
-                    for token in tokens:
-                        if pat.match(token):
-                            speaker_category[speaker][cat] += 1
-        
-        # Make an empty row if there are no speakers for this window
-        if len(df_window) == 0 or len(speaker_category) == 0:
-            _ = speaker_category["None"]
-        
-        # For each speaker we found in the current window, create a row
-        # that includes category counts for all categories.
-        # If a speaker has zero for a category, it won't appear in speaker_category,
-        # so we must fill in 0 for missing categories.
-        for speaker, cat_counts in speaker_category.items():
-            row_dict = {
-                'speaker': speaker,
-                'window_start': window_start,
-                'window_end':   window_end
-            }
-            # Make sure all categories appear
-            for cat in all_categories:
-                row_dict[cat] = cat_counts.get(cat, 0)
-
-            speaker_time_series.append(row_dict)
-        
+
+    # Only participant utterances are counted
+    transcript_df = transcript_df[transcript_df['speaker'].isin(participant_speakers)].reset_index(drop=True)
+    transcript_df['speaker'] = transcript_df['speaker'].cat.set_categories(sorted(transcript_df['speaker'].unique()))
+
+    # Assign every utterance to its windows up front, instead of re-filtering
+    # the whole transcript for every window
+    row_ids, window_ids = assign_windows(transcript_df['end'].to_numpy(), time_points, task_cutoff['start'])
+
+    # Speakers are identified by their (sorted) categorical codes; "None" marks empty windows
+    speakers = transcript_df['speaker'].cat.categories
+    speaker_categories = [*speakers, 'None']
+    n_windows, n_speakers, n_cats = len(time_points), len(speakers), len(all_categories)
+
+    # Integer-encode the tokens (indexed by utterance) and resolve each
+    # distinct token's category ids once, with vectorized hash lookups
+    tokens = transcript_df['text'].explode().dropna()
+    token_rows = tokens.index.to_numpy(dtype=int)
+    token_codes, vocab = pd.factorize(tokens)
+    vocab = pd.Series(vocab)
+
+    # Direct words, then trailing wildcards by looking up each token's prefix
+    # of every length present in the dictionary, then any other wildcards
+    vocab_matches = [lookup_codes(vocab, cata_dict['word_to_cat'], 'word')]
+    prefix_to_cat = cata_dict['prefix_to_cat']
+    for length, table in prefix_to_cat.groupby(prefix_to_cat['prefix'].str.len()):
+        vocab_matches.append(lookup_codes(vocab[vocab.str.len() >= length].str[:length], table, 'prefix'))
+
+    # Other wildcards scan the whole vocabulary at once: the fused pattern picks
+    # out candidate tokens, and only those are matched against each pattern
+    if cata_dict['any_other_pattern'] is not None:
+        candidates = vocab[vocab.str.match(cata_dict['any_other_pattern'])]
+        for pat, cat_id in cata_dict['other_patterns']:
+            hits = candidates[candidates.str.match(pat)]
+            vocab_matches.append(pd.DataFrame({'code': hits.index, 'cat_id': cat_id}))
+    vocab_matches = pd.concat(vocab_matches).sort_values('code', kind='stable')
+
+    vocab_n_cats = np.bincount(vocab_matches['code'].to_numpy(dtype=int), minlength=len(vocab))
+    vocab_cat_ids = vocab_matches['cat_id'].to_numpy(dtype=int)
+    vocab_offsets = np.cumsum(vocab_n_cats) - vocab_n_cats
+
+    # Expand to one entry per (token, category) match; a token may count towards
+    # several categories, and tokens matching none drop out
+    token_n_cats = vocab_n_cats[token_codes]
+    match_rows = np.repeat(token_rows, token_n_cats)
+    match_cats = vocab_cat_ids[expand_ranges(vocab_offsets[token_codes], token_n_cats)]
+
+    # Aggregate to per-utterance category counts first, so each utterance rather
+    # than each matched token is paired with its windows
+    utterance_counts = np.bincount(match_rows * n_cats + match_cats, minlength=len(transcript_df) * n_cats)
+    utterance_counts = utterance_counts.reshape(len(transcript_df), n_cats).astype(np.int16)
+
+    # Sum the utterance counts per (window, speaker) into a dense counts[window_id, speaker_id, cat_id]
+    # array; int16 is ample for the matches of a 30-second window and keeps the array small
+    speaker_ids = transcript_df['speaker'].cat.codes.to_numpy(dtype=int)
+    counts = np.zeros((n_windows, n_speakers, n_cats), dtype=np.int16)
+    np.add.at(counts, (window_ids, speaker_ids[row_ids]), utterance_counts[row_ids])
+
+    # Only (window, speaker) cells with at least one match become rows, and
+    # windows without any speaker get a single empty "None" row
+    active_windows, active_speakers = np.nonzero(counts.any(axis=2))
+    empty_windows = np.flatnonzero(~counts.any(axis=(1, 2)))
+    row_windows = np.concatenate([active_windows, empty_windows])
+    row_speakers = np.concatenate([active_speakers, np.full(len(empty_windows), n_speakers)])
+    row_counts = np.concatenate([counts[active_windows, active_speakers], np.zeros((len(empty_windows), n_cats), counts.dtype)])
+
     # Convert to DataFrame
-    speaker_time_series_df = pd.DataFrame(speaker_time_series)
+    speaker_time_series_df = pd.DataFrame({
+        'speaker': pd.Categorical.from_codes(row_speakers, speaker_categories),
+        'window_start': time_points[row_windows],
+        'window_end': time_points[row_windows] + window_size,
+        **dict(zip(all_categories, row_counts.T)),
+    })
     speaker_time_series_df.sort_values(by=['window_start','speaker'], inplace=True)
     
-    # Output each individual speaker's time series as a separate CSV file
-        for speaker in speaker_time_series_df[speaker_time_series_df['speaker'] != 'None']['speaker'].unique():
-        df_single = speaker_time_series_df[speaker_time_series_df['speaker'].isin([speaker, 'None'])]
-
-        missing_rows = speaker_time_series_df[~speaker_time_series_df['window_start'].isin(
-            df_single['window_start'])].groupby(['window_start', 'window_end']).agg(
-            {'speaker': (lambda x: "None"), **{col: (lambda x: 0) for col in speaker_time_series_df.columns if
-             col not in ['window_start', 'window_end', 'speaker']}}
-        )
-
-        df_single = pd.concat([df_single, missing_rows], ignore_index=True).sort_values(by=[
-            'window_start']).reset_index(drop=True)
+    # Output each individual speaker's time series as a separate CSV file,
+    # with one row per window: the speaker's counts where they have any
+    # matches, and an empty "None" row elsewhere
+    for speaker_id, speaker in enumerate(speakers):
+        speaker_counts = counts[:, speaker_id]
+        speaker_active = speaker_counts.any(axis=1)
+        if not speaker_active.any():
+            continue
+
+        df_single = pd.DataFrame({
+            'speaker': np.where(speaker_active, speaker, 'None'),
+            'window_start': time_points,
+            'window_end': time_points + window_size,
+            **dict(zip(all_categories, speaker_counts.T)),
+        })
         
         # Build a filename for this speaker
         output_filename = f"{output_speaker_dir}/{speaker}_time_series.csv"
-        df_single.to_csv(output_filename, index=False)
+        write_csv(df_single, output_filename)
         print(f"Saved {output_filename}")
     
-    # We can group by (window_start, window_end) and sum across speakers
-    speaker_agg = lambda x: ', '.join(sorted(x.unique()))
-
-    group_time_series_df = speaker_time_series_df.groupby(['window_start', 'window_end']).agg(
-        {**{col: 'sum' for col in speaker_time_series_df.columns if col not in ['window_start', 'window_end', 'speaker']},
-        'speaker': speaker_agg}
-    ).reset_index()
+    # Sum across speakers directly on the counts array, and list each window's
+    # speakers from the frame, which is already sorted by window and speaker
+    window_speakers = speaker_time_series_df.groupby(['window_start', 'window_end'])['speaker'].agg(', '.join)
+    group_time_series_df = pd.DataFrame({
+        'window_start': time_points,
+        'window_end': time_points + window_size,
+        **dict(zip(all_categories, counts.sum(axis=1).T)),
+        'speaker': window_speakers.to_numpy(),
+    })
 
     group_time_series_df.to_csv(result_path, index=False)
     print(f"Analyzing {transcript_path} -> Saving results to {result_path}")
@@ -166,11 +283,15 @@ def main():
     # Ensure output directories exist
     os.makedirs(output_base_dir, exist_ok=True)
     
+    # Parse the CATA dictionary once for all groups
+    cata_dict = load_dictionary(dict_file)
+
     # Open and load the task cutoff times JSON file
     with open(json_file_path, 'r') as f:
         task_cutoffs = json.load(f)
 
     # Loop through each group folder for Groups 1 to 12
+    jobs = []
     for i in range(1, num_groups + 1):
         output_group_dir = os.path.join(output_base_dir, f"group_{i}")
 
@@ -189,8 +310,13 @@ def main():
             output_speaker_dir = os.path.join(output_group_dir, f"{prefix}_speaker_time_series")
             os.makedirs(output_speaker_dir, exist_ok=True)
 
-            # Call the text analysis function
-            analyze_text(transcript_path, output_speaker_dir, output_path, task_cutoffs[f"group {i}"])
+            jobs.append((transcript_path, output_speaker_dir, output_path, task_cutoffs[f"group {i}"]))
+
+    # Groups are independent, so analyze them in parallel worker processes
+    with ProcessPoolExecutor(max_workers=max(1, min(len(jobs), os.cpu_count() or 1))) as executor:
+        futures = [executor.submit(analyze_text, *job, cata_dict) for job in jobs]
+        for future in as_completed(futures):
+            future.result()
 
     print("Processing complete!")
 